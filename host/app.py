@@ -2,15 +2,26 @@ import os
 import json
 import subprocess
 import socket
+import http.client
+import threading
+import time
+import shutil
+import tempfile
+import struct
 from ipaddress import ip_network, ip_address
-from flask import Flask, render_template, request, redirect, url_for, flash
+from urllib.parse import urlparse
+from flask import Flask, render_template, request, redirect, url_for, flash, get_flashed_messages, session, jsonify, Response, stream_with_context
 
 app = Flask(__name__)
-app.config['TEMPLATES_AUTO_RELOAD'] = True
+# Checking templates for changes costs a stat per render, only do it when asked
+app.config['TEMPLATES_AUTO_RELOAD'] = os.environ.get('TEMPLATES_AUTO_RELOAD') == '1'
 app.secret_key = 'supersecretkey123'
 
 CONFIG_FILE = 'host_config.json'
 
+# Lab networks leave room for VXLAN headers so they can be stretched across Docker daemons
+LAB_MTU = 1450
+
 # Initialize JSON file if it doesn't exist or is invalid
 def init_config_file():
     if not os.path.exists(CONFIG_FILE) or os.path.getsize(CONFIG_FILE) == 0:
@@ -36,13 +47,87 @@ def save_config(config):
     try:
         with open(CONFIG_FILE, 'w') as f:
             json.dump(config, f, indent=4)
+        bump_config_version()
     except Exception as e:
         flash(f'Error saving config: {str(e)}', 'error')
 
+# Cache of the parsed config and of pages rendered from it, keyed by a
+# version that moves on every save and whenever the file changes on disk
+# behind our back (e.g. a snapshot restore copying a new config in)
+BOOT_ID = f'{int(time.time()):x}'
+config_cache_lock = threading.Lock()
+config_cache = {'version': 0, 'stat': None, 'config': None, 'pages': {}}
+
+def config_stat():
+    try:
+        st = os.stat(CONFIG_FILE)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def bump_config_version():
+    with config_cache_lock:
+        config_cache.update({'version': config_cache['version'] + 1, 'stat': config_stat(),
+                             'config': None, 'pages': {}})
+
+def config_version():
+    stat = config_stat()
+    with config_cache_lock:
+        if stat != config_cache['stat']:
+            config_cache.update({'version': config_cache['version'] + 1, 'stat': stat,
+                                 'config': None, 'pages': {}})
+        return config_cache['version']
+
+# Read-only view of the config, parsed once per version
+def cached_config():
+    version = config_version()
+    config = config_cache['config']
+    if config is None:
+        config = load_config()
+        with config_cache_lock:
+            if config_cache['version'] == version:
+                config_cache['config'] = config
+    return config
+
+# Serve a page from the cache with an ETag so unchanged polls get a 304
+def cached_response(key, render, mimetype='text/html'):
+    # Template edits don't bump the version, so render fresh while they are reloaded
+    if app.config['TEMPLATES_AUTO_RELOAD']:
+        return Response(render(), mimetype=mimetype)
+    version = config_version()
+    etag = f'{BOOT_ID}-{version}-{key}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = config_cache['pages'].get(key)
+        if body is None:
+            body = render()
+            with config_cache_lock:
+                if config_cache['version'] == version:
+                    config_cache['pages'][key] = body
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def render_index():
+    config = cached_config()
+    return render_template('index.html', interface=config.get('interface', {}))
+
 @app.route('/')
 def index():
-    config = load_config()
-    return render_template('index.html', interface=config.get('interface', {}))
+    # Pending flash messages make the page specific to this visitor
+    if session.get('_flashes'):
+        return render_index()
+    return cached_response('index', render_index)
+
+@app.route('/config')
+def config_view():
+    return cached_response('config', lambda: json.dumps(cached_config()), mimetype='application/json')
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
 
 @app.route('/set_interface', methods=['POST'])
 def set_interface():
@@ -139,6 +224,7 @@ def set_interface():
             create_result = subprocess.run([
                 "docker", "network", "create",
                 "--subnet", subnet,
+                "-o", f"com.docker.network.driver.mtu={LAB_MTU}",
                 network_name
             ], capture_output=True, text=True, check=True)
             if create_result.returncode != 0:
@@ -249,6 +335,365 @@ def ping():
         flash(f'Error pinging {target_ip}: {str(e)}', 'error')
     return redirect(url_for('index'))
 
+# Packet capture sessions
+# tcpdump writes pcap straight to its own ring of rotating files, so disk use
+# is capped and no packet passes through this process while capturing.
+# Downloads join the files; summaries are only decoded by a stream request,
+# in batches, for as long as someone is watching.
+CAPTURE_LIMIT = 4
+CAPTURE_DIR = os.path.join(tempfile.gettempdir(), 'captures')
+CAPTURE_FILES = 4
+CAPTURE_BUFFER_BYTES = 4 * 1000 * 1000
+CAPTURE_MAX_BUFFER_BYTES = 32 * 1000 * 1000
+CAPTURE_SNAPLEN = 1600
+CAPTURE_STREAM_INTERVAL = 0.25
+CAPTURE_STREAM_READ = 256 * 1024
+CAPTURE_STREAM_BATCH = 200
+CAPTURE_KEEPALIVE = 15
+PCAP_HEADER = 24
+
+captures_lock = threading.Lock()
+captures = {}
+capture_counter = [0]
+
+def summarize_packet(data, link_type):
+    # Only Ethernet frames are decoded
+    if link_type != 1 or len(data) < 14:
+        return f'{len(data)} bytes'
+    ethertype = struct.unpack('!H', data[12:14])[0]
+    payload = data[14:]
+    if ethertype == 0x0806:
+        if len(payload) >= 28:
+            op = 'request' if payload[7] == 1 else 'reply'
+            return f'ARP {op} {socket.inet_ntoa(payload[14:18])} > {socket.inet_ntoa(payload[24:28])}'
+        return 'ARP'
+    if ethertype == 0x0800 and len(payload) >= 20:
+        header_length = (payload[0] & 0x0F) * 4
+        protocol = payload[9]
+        src, dst = socket.inet_ntoa(payload[12:16]), socket.inet_ntoa(payload[16:20])
+        name = {1: 'ICMP', 6: 'TCP', 17: 'UDP'}.get(protocol, f'proto {protocol}')
+        if protocol in (6, 17) and len(payload) >= header_length + 4:
+            sport, dport = struct.unpack('!HH', payload[header_length:header_length + 4])
+            return f'IP {src}:{sport} > {dst}:{dport} {name}'
+        return f'IP {src} > {dst} {name}'
+    if ethertype == 0x86DD and len(payload) >= 40:
+        return f'IP6 {socket.inet_ntop(socket.AF_INET6, payload[8:24])} > {socket.inet_ntop(socket.AF_INET6, payload[24:40])}'
+    return f'ethertype 0x{ethertype:04x}'
+
+# The ring files of a session, oldest first
+def capture_files(session):
+    try:
+        paths = [os.path.join(session['dir'], name) for name in os.listdir(session['dir'])]
+        return sorted(paths, key=lambda path: (os.stat(path).st_mtime_ns, path))
+    except FileNotFoundError:
+        # Deleted under us
+        return []
+
+def pcap_format(header):
+    endian = '<' if header[:4] in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1') else '>'
+    return endian, struct.unpack(endian + 'I', header[20:24])[0]
+
+# Split complete records off a chunk of pcap data; returns them and the bytes used
+def pcap_records(data, endian):
+    records = []
+    offset = 0
+    while offset + 16 <= len(data):
+        ts_sec, ts_frac, incl_len, orig_len = struct.unpack(endian + 'IIII', data[offset:offset + 16])
+        if offset + 16 + incl_len > len(data):
+            break
+        records.append((ts_sec + ts_frac / 1e6, orig_len, data[offset + 16:offset + 16 + incl_len]))
+        offset += 16 + incl_len
+    return records, offset
+
+def capture_watcher(session):
+    session['process'].wait()
+    session['running'] = False
+    if session['process'].returncode not in (0, -15) and not session['error']:
+        session['error'] = session['process'].stderr.read().decode(errors='replace').strip()
+
+def capture_info(session):
+    files = capture_files(session)
+    return {
+        'id': session['id'],
+        'interface': session['interface'],
+        'filter': session['filter'],
+        'started': session['started'],
+        'running': session['running'],
+        'files': len(files),
+        'bytes': sum(os.path.getsize(path) for path in files),
+        'buffer_bytes': session['buffer_bytes'],
+        'stream_drops': session['stream_drops'],
+        'error': session['error']
+    }
+
+def get_capture(capture_id):
+    with captures_lock:
+        return captures.get(capture_id)
+
+def remove_capture(session):
+    if session['running']:
+        session['process'].terminate()
+    shutil.rmtree(session['dir'], ignore_errors=True)
+
+@app.route('/captures', methods=['GET'])
+def list_captures():
+    with captures_lock:
+        sessions = list(captures.values())
+    return jsonify({'captures': [capture_info(session) for session in sessions]})
+
+@app.route('/captures', methods=['POST'])
+def start_capture():
+    data = request.get_json(silent=True) or request.form
+    interface = data.get('interface', '').strip()
+    bpf_filter = data.get('filter', '').strip()
+    try:
+        buffer_bytes = int(data.get('buffer_bytes') or CAPTURE_BUFFER_BYTES)
+        snaplen = int(data.get('snaplen') or CAPTURE_SNAPLEN)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid capture size: {str(e)}'}), 400
+
+    if interface not in os.listdir('/sys/class/net'):
+        return jsonify({'error': f'Unknown interface: {interface}'}), 400
+    if bpf_filter.startswith('-'):
+        return jsonify({'error': 'Invalid capture filter'}), 400
+    if not 0 < buffer_bytes <= CAPTURE_MAX_BUFFER_BYTES or not 0 < snaplen <= 65535:
+        return jsonify({'error': f'Buffer must be at most {CAPTURE_MAX_BUFFER_BYTES} bytes and snaplen at most 65535'}), 400
+    # tcpdump rotates in whole megabytes (-C counts 1,000,000 bytes)
+    file_megabytes = max(1, buffer_bytes // (CAPTURE_FILES * 1000 * 1000))
+
+    with captures_lock:
+        # Stopped captures still hold their files, so they count too
+        if len(captures) >= CAPTURE_LIMIT:
+            return jsonify({'error': f'At most {CAPTURE_LIMIT} captures at a time, delete one first'}), 429
+        capture_counter[0] += 1
+        capture_id = str(capture_counter[0])
+
+    capture_dir = os.path.join(CAPTURE_DIR, capture_id)
+    os.makedirs(capture_dir, exist_ok=True)
+    command = ['nice', '-n', '10', 'tcpdump', '-i', interface, '-n', '-U', '-s', str(snaplen), '-Z', 'root',
+               '-C', str(file_megabytes), '-W', str(CAPTURE_FILES), '-w', os.path.join(capture_dir, 'capture.pcap')]
+    if bpf_filter:
+        command.append(bpf_filter)
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError as e:
+        shutil.rmtree(capture_dir, ignore_errors=True)
+        return jsonify({'error': f'Failed to start tcpdump: {str(e)}'}), 500
+    # A bad filter or interface makes tcpdump exit right away
+    try:
+        process.wait(timeout=0.3)
+        shutil.rmtree(capture_dir, ignore_errors=True)
+        return jsonify({'error': f"tcpdump failed: {process.stderr.read().decode(errors='replace').strip()}"}), 400
+    except subprocess.TimeoutExpired:
+        pass
+
+    session = {
+        'id': capture_id,
+        'interface': interface,
+        'filter': bpf_filter,
+        'started': time.time(),
+        'running': True,
+        'process': process,
+        'dir': capture_dir,
+        'buffer_bytes': file_megabytes * CAPTURE_FILES * 1000 * 1000,
+        'stream_drops': 0,
+        'error': None
+    }
+    with captures_lock:
+        # Another start may have taken the last slot meanwhile
+        if len(captures) >= CAPTURE_LIMIT:
+            remove_capture(session)
+            return jsonify({'error': f'At most {CAPTURE_LIMIT} captures at a time, delete one first'}), 429
+        captures[capture_id] = session
+    threading.Thread(target=capture_watcher, args=(session,), daemon=True).start()
+    return jsonify(capture_info(session)), 201
+
+@app.route('/captures/<capture_id>/stop', methods=['POST'])
+def stop_capture(capture_id):
+    session = get_capture(capture_id)
+    if not session:
+        return jsonify({'error': f'No capture {capture_id}'}), 404
+    if session['running']:
+        session['process'].terminate()
+    return jsonify(capture_info(session))
+
+@app.route('/captures/<capture_id>/delete', methods=['POST'])
+def delete_capture(capture_id):
+    with captures_lock:
+        session = captures.pop(capture_id, None)
+    if not session:
+        return jsonify({'error': f'No capture {capture_id}'}), 404
+    remove_capture(session)
+    return jsonify({'message': f'Capture {capture_id} deleted'})
+
+@app.route('/captures/<capture_id>/pcap')
+def download_capture(capture_id):
+    session = get_capture(capture_id)
+    if not session:
+        return jsonify({'error': f'No capture {capture_id}'}), 404
+    # Every ring file starts with its own pcap header, keep only the first
+    parts = []
+    for path in capture_files(session):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        if len(data) >= PCAP_HEADER:
+            parts.append(data if not parts else data[PCAP_HEADER:])
+    if not parts:
+        return jsonify({'error': 'Capture has no data yet'}), 409
+    return Response(b''.join(parts), mimetype='application/vnd.tcpdump.pcap', headers={
+        'Content-Disposition': f"attachment; filename={socket.gethostname()}-{session['interface']}-{capture_id}.pcap"
+    })
+
+@app.route('/captures/<capture_id>/stream')
+def stream_capture(capture_id):
+    session = get_capture(capture_id)
+    if not session:
+        return jsonify({'error': f'No capture {capture_id}'}), 404
+
+    # Follow the newest ring file from its current end. Each poll reads a
+    # bounded chunk and summarizes at most CAPTURE_STREAM_BATCH packets of
+    # it; the rest, and anything rotated away before it was read, is dropped.
+    def events():
+        path, offset, endian, link_type = None, 0, None, None
+        idle = 0
+        while True:
+            files = capture_files(session)
+            if path not in files or (path != files[-1] and offset >= os.path.getsize(path)):
+                if path is not None and path in files:
+                    # Done with this file, the next one starts where it left off
+                    path = files[files.index(path) + 1]
+                    offset = 0
+                elif files:
+                    # First poll or fell behind the ring: skip to the newest file's end
+                    path = files[-1]
+                    offset = -1
+                else:
+                    path = None
+            batch = []
+            if path is not None:
+                try:
+                    with open(path, 'rb') as f:
+                        if offset <= 0:
+                            header = f.read(PCAP_HEADER)
+                            if len(header) == PCAP_HEADER:
+                                endian, link_type = pcap_format(header)
+                                if offset < 0:
+                                    # Walk to the last complete record without decoding
+                                    _, used = pcap_records(f.read(), endian)
+                                    offset = PCAP_HEADER + used
+                                else:
+                                    offset = PCAP_HEADER
+                        if offset >= PCAP_HEADER:
+                            f.seek(offset)
+                            if os.path.getsize(path) < offset:
+                                # The ring reused the file under us
+                                path = None
+                            else:
+                                records, used = pcap_records(f.read(CAPTURE_STREAM_READ), endian)
+                                offset += used
+                                batch = [{'time': when, 'length': length, 'summary': summarize_packet(data, link_type)}
+                                          for when, length, data in records[:CAPTURE_STREAM_BATCH]]
+                                session['stream_drops'] += max(0, len(records) - CAPTURE_STREAM_BATCH)
+                except FileNotFoundError:
+                    path = None
+
+            for event in batch:
+                yield f'data: {json.dumps(event)}\n\n'
+            if batch:
+                idle = 0
+            elif not session['running'] and (path is None or path == files[-1]):
+                yield 'event: end\ndata: {}\n\n'
+                break
+            else:
+                idle += CAPTURE_STREAM_INTERVAL
+                if idle >= CAPTURE_KEEPALIVE:
+                    idle = 0
+                    yield ': keepalive\n\n'
+            time.sleep(CAPTURE_STREAM_INTERVAL)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+# Agent channel to the topology app
+# A single keep-alive connection long-polls for config batches; each
+# operation is run through the same view as the matching UI form and the
+# flashed messages come back as its ack on the next poll.
+NODE_NAME = os.environ.get('NODE_NAME', socket.gethostname())
+TOPOLOGY_URL = os.environ.get('TOPOLOGY_URL')
+AGENT_POLL_TIMEOUT = 25
+AGENT_STARTED = time.time()
+
+def run_agent_op(op):
+    name = op.get('op')
+    if name not in AGENT_OPS:
+        return {'op': name, 'ok': False, 'messages': [f'Unknown operation: {name}']}
+    args = {'index': op['index']} if 'index' in op else {}
+    form = {key: value for key, value in op.items() if key not in ('op', 'index')}
+    try:
+        with app.test_request_context():
+            path = url_for(name, **args)
+        with app.test_request_context(path, method=AGENT_OPS[name], data=form):
+            response = app.full_dispatch_request()
+            messages = get_flashed_messages(with_categories=True)
+    except Exception as e:
+        return {'op': name, 'ok': False, 'messages': [str(e)]}
+    # Every view reports its outcome as a flash; no flash means nothing ran
+    if not messages:
+        messages = [('error', f'No result reported (HTTP {response.status_code})')]
+    return {
+        'op': name,
+        'ok': response.status_code < 400 and all(category != 'error' for category, _ in messages),
+        'messages': [message for _, message in messages]
+    }
+
+def agent_loop():
+    url = urlparse(TOPOLOGY_URL)
+    conn = None
+    acks = []
+    backoff = 1
+    while True:
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=AGENT_POLL_TIMEOUT + 10)
+            body = json.dumps({'node': NODE_NAME, 'acks': acks, 'health': agent_health()})
+            conn.request('POST', '/agent/poll', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            reply = json.loads(response.read())
+            if response.status != 200:
+                raise ValueError(reply.get('error'))
+            acks = [{'batch': batch['id'], 'results': [run_agent_op(op) for op in batch['ops']]}
+                    for batch in reply.get('batches', [])]
+            backoff = 1
+        except (OSError, http.client.HTTPException, ValueError):
+            if conn:
+                conn.close()
+                conn = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+AGENT_OPS = {
+    'set_interface': 'POST',
+    'delete_interface': 'GET'
+}
+
+def agent_health():
+    return {
+        'uptime': round(time.time() - AGENT_STARTED),
+        'load': os.getloadavg()[0],
+        'configured': bool(cached_config()['interface']),
+        'captures': len(captures)
+    }
+
+# With debug on (FLASK_ENV=development) app.run starts a reloader that runs
+# this module twice; background work belongs in the serving process only
+def serving_process():
+    return not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
 if __name__ == '__main__':
     init_config_file()
+    if serving_process() and TOPOLOGY_URL:
+        threading.Thread(target=agent_loop, daemon=True).start()
     app.run(host='0.0.0.0', port=5003)
\ No newline at end of file
@@ -1,6 +1,20 @@
 import os
+import io
+import re
 import json
-from flask import Flask, render_template, request, jsonify
+import gzip
+import math
+import time
+import zlib
+import tarfile
+import threading
+import http.client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from ipaddress import ip_network
+from urllib.parse import urlparse
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import subprocess
 
 app = Flask(__name__)
@@ -8,6 +22,13 @@ app.secret_key = 'supersecretkey123'
 
 CONFIG_FILE = 'topologies.json'
 
+# Where node agents reach this app from inside their containers: through the
+# Docker host gateway on the local daemon, and on the address of this host
+# other daemons can route to (TOPOLOGY_ADDRESS) anywhere else
+TOPOLOGY_URL = os.environ.get('TOPOLOGY_URL', 'http://host.docker.internal:5000')
+TOPOLOGY_ADDRESS = os.environ.get('TOPOLOGY_ADDRESS')
+TOPOLOGY_PORT = 5000
+
 @app.route('/launch_node', methods=['POST'])
 def launch_node():
     data = request.get_json()
@@ -17,41 +38,196 @@ def launch_node():
     if not node_type or not node_id:
         return jsonify({'error': 'Missing node type or id'}), 400
 
-    container_name = f"{node_type.lower()}{node_id}"
-    image_name = node_type.lower()
+    try:
+        image_name = node_type.lower()
+        daemon = place_container(f"{image_name}{node_id}")
+        ensure_image(image_name, daemon)
+        url = start_container(image_name, node_id, daemon)
+        return jsonify({'url': url, 'daemon': daemon['name']})
+    except subprocess.CalledProcessError as e:
+        return jsonify({'error': str(e)}), 500
 
+def node_ports(image_name, node_id):
     base_port = {
         'router': 5002,
         'host': 5003
     }.get(image_name, 5000)
 
-    dynamic_port = base_port + 10 * int(node_id)
-
-    try:
-        # Build image if it doesn't exist
-        images = subprocess.check_output(['docker', 'images', '-q', image_name]).decode().strip()
-        if not images:
-            subprocess.run(['docker', 'build', '-t', image_name, f'../{image_name}'], check=True)
-
-        # Check if container already exists
-        containers = subprocess.check_output(['docker', 'ps', '-a', '--format', '{{.Names}}']).decode().splitlines()
-        if container_name not in containers:
-            local_folder = os.path.abspath(f"../{image_name}")
-            subprocess.run([
-                'docker', 'run', '-dit',
-                '--name', container_name,
-                '-p', f'{dynamic_port}:{base_port}',
-                '--cap-add=NET_ADMIN',
-                '-v', '/var/run/docker.sock:/var/run/docker.sock',
-                '-v', f'{local_folder}/templates:/app/templates',
-                '-v', f'{local_folder}/static:/app/static',
-                '-v', f'{local_folder}/app.py:/app/app.py',
-                image_name
-            ], check=True)
-
-        return jsonify({'url': f'http://localhost:{dynamic_port}'})
-    except subprocess.CalledProcessError as e:
-        return jsonify({'error': str(e)}), 500
+    return base_port, base_port + 10 * int(node_id)
+
+# Build image if it doesn't exist
+def ensure_image(image_name, daemon):
+    images = subprocess.check_output(docker_cmd(daemon) + ['images', '-q', image_name]).decode().strip()
+    if not images:
+        subprocess.run(docker_cmd(daemon) + ['build', '-t', image_name, f'../{image_name}'], check=True)
+
+def container_args(image_name, node_id, daemon):
+    base_port, dynamic_port = node_ports(image_name, node_id)
+    args = [
+        '--name', f"{image_name}{node_id}",
+        '-p', f'{dynamic_port}:{base_port}',
+        '--cap-add=NET_ADMIN',
+        '--add-host', 'host.docker.internal:host-gateway',
+        '-e', f'NODE_NAME={image_name}{node_id}',
+        '-v', '/var/run/docker.sock:/var/run/docker.sock'
+    ]
+    url = agent_url(daemon)
+    if url:
+        args += ['-e', f'TOPOLOGY_URL={url}']
+    # Source folders can only be mounted where the daemon sees this filesystem
+    if daemon.get('mount_sources'):
+        local_folder = os.path.abspath(f"../{image_name}")
+        args += [
+            '-v', f'{local_folder}/templates:/app/templates',
+            '-v', f'{local_folder}/static:/app/static',
+            '-v', f'{local_folder}/app.py:/app/app.py'
+        ]
+    return args + [image_name]
+
+# None when nodes on that daemon have no way back to us, they run without an agent then
+def agent_url(daemon):
+    if daemon['name'] == LOCAL_DAEMON['name']:
+        return TOPOLOGY_URL
+    if TOPOLOGY_ADDRESS:
+        return f'http://{TOPOLOGY_ADDRESS}:{TOPOLOGY_PORT}'
+    return None
+
+def list_containers(daemon):
+    return subprocess.check_output(docker_cmd(daemon) + ['ps', '-a', '--format', '{{.Names}}']).decode().splitlines()
+
+def start_container(image_name, node_id, daemon):
+    container_name = f"{image_name}{node_id}"
+
+    # Check if container already exists
+    if container_name not in list_containers(daemon):
+        subprocess.run(docker_cmd(daemon) + ['run', '-dit'] + container_args(image_name, node_id, daemon), check=True)
+        track_launch(container_name)
+
+    return f"http://{daemon['address']}:{node_ports(image_name, node_id)[1]}"
+
+# Docker daemons nodes run on, with capacity weights, and the daemon each container was placed on
+DAEMONS_FILE = 'daemons.json'
+LOCAL_DAEMON = {
+    'name': 'local',
+    'endpoint': 'unix:///var/run/docker.sock',
+    'weight': 1,
+    'address': 'localhost',
+    'mount_sources': True
+}
+VXLAN_PORT = 4789
+# VXLAN adds 50 bytes per frame, so lab networks are created with this MTU
+# (here and in the node apps) to fit a 1500 byte underlay
+LAB_MTU = 1450
+
+daemons_lock = threading.Lock()
+
+def load_daemons():
+    try:
+        with open(DAEMONS_FILE, 'r') as f:
+            state = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        state = {}
+    if not state.get('daemons'):
+        state['daemons'] = [dict(LOCAL_DAEMON)]
+    state.setdefault('placement', {})
+    return state
+
+def save_daemons(state):
+    with open(DAEMONS_FILE, 'w') as f:
+        json.dump(state, f, indent=4)
+
+def docker_cmd(daemon):
+    return ['docker', '-H', daemon['endpoint']]
+
+def container_daemon(container, state=None):
+    state = state or load_daemons()
+    daemons = {daemon['name']: daemon for daemon in state['daemons']}
+    # Containers from before placement existed live on the local daemon
+    fallback = daemons.get(LOCAL_DAEMON['name'], state['daemons'][0])
+    return daemons.get(state['placement'].get(container), fallback)
+
+def container_docker(container, state=None):
+    return docker_cmd(container_daemon(container, state))
+
+# How strongly containers are linked: one per direct link, and one
+# between every pair of containers hanging off the same switch
+def link_affinity(config):
+    nodes = {node['id']: node for node in config['nodes']}
+    linked = {}
+    for edge in config['edges']:
+        linked.setdefault(edge['source'], []).append(edge['target'])
+        linked.setdefault(edge['target'], []).append(edge['source'])
+
+    affinity = {}
+    for node_id, neighbors in linked.items():
+        node = nodes.get(node_id)
+        members = [nodes[n] for n in neighbors if n in nodes and nodes[n]['type'] != 'Switch']
+        if not node:
+            continue
+        if node['type'] == 'Switch':
+            pairs = [(a, b) for a in members for b in members if a is not b]
+        else:
+            pairs = [(node, other) for other in members]
+        for a, b in pairs:
+            weights = affinity.setdefault(node_container(a), {})
+            weights[node_container(b)] = weights.get(node_container(b), 0) + 1
+    return affinity
+
+# Place every unplaced container of the topology (plus any extra ones).
+# Containers are visited breadth-first along their links, starting from
+# the best linked ones, and each goes to the daemon holding most of its
+# already placed neighbors that is still under its weighted share.
+def place_nodes(config, state, extra=()):
+    daemons = state['daemons']
+    placement = state['placement']
+    containers = [node_container(node) for node in config['nodes'] if node['type'] != 'Switch']
+    containers += [container for container in extra if container not in containers]
+    affinity = link_affinity(config)
+
+    load = {daemon['name']: 0 for daemon in daemons}
+    for daemon_name in placement.values():
+        if daemon_name in load:
+            load[daemon_name] += 1
+    total = len(set(containers) | set(placement))
+    total_weight = sum(daemon['weight'] for daemon in daemons)
+    capacity = {daemon['name']: math.ceil(total * daemon['weight'] / total_weight) for daemon in daemons}
+
+    order = []
+    seen = set(placement)
+    for start in sorted(containers, key=lambda c: -sum(affinity.get(c, {}).values())):
+        queue = deque([start])
+        while queue:
+            container = queue.popleft()
+            if container in seen:
+                continue
+            seen.add(container)
+            order.append(container)
+            queue.extend(sorted(affinity.get(container, {}), key=lambda n: -affinity[container][n]))
+
+    for container in order:
+        def score(daemon):
+            linked = sum(weight for other, weight in affinity.get(container, {}).items()
+                         if placement.get(other) == daemon['name'])
+            return (load[daemon['name']] < capacity[daemon['name']], linked, -load[daemon['name']] / daemon['weight'])
+        best = max(daemons, key=score)
+        placement[container] = best['name']
+        load[best['name']] += 1
+    return placement
+
+def place_container(container):
+    with daemons_lock:
+        state = load_daemons()
+        if container not in state['placement']:
+            place_nodes(load_config(), state, extra=[container])
+            save_daemons(state)
+        return container_daemon(container, state)
+
+def daemon_loads(state):
+    loads = {daemon['name']: 0 for daemon in state['daemons']}
+    for daemon_name in state['placement'].values():
+        if daemon_name in loads:
+            loads[daemon_name] += 1
+    return loads
 
 # Initialize JSON file if it doesn't exist
 def init_config_file():
@@ -96,6 +272,14 @@ def save_topology():
     if not data or 'nodes' not in data or 'edges' not in data:
         return jsonify({'error': 'Invalid topology data'}), 400
     config = {'nodes': data['nodes'], 'edges': data['edges']}
+
+    # The canvas does not edit link profiles, keep the ones already stored
+    stored = {edge_key(edge): edge for edge in load_config()['edges']}
+    for edge in config['edges']:
+        previous = stored.get(edge_key(edge))
+        if previous and not any(attr in edge for attr in LINK_ATTRS):
+            edge.update({attr: previous[attr] for attr in LINK_ATTRS if attr in previous})
+
     error = save_config(config)
     if error:
         return jsonify({'error': error}), 500
@@ -110,17 +294,21 @@ def clear_topology():
         if error:
             return jsonify({'error': f'Failed to clear topology: {error}'}), 500
 
-        # Delete Docker networks starting with "net"
-        networks = subprocess.check_output(['docker', 'network', 'ls', '--format', '{{.Name}}']).decode().splitlines()
-        for network in networks:
-            if network.startswith('net'):
-                subprocess.run(['docker', 'network', 'rm', network], check=False, capture_output=True)
+        with daemons_lock:
+            state = load_daemons()
+            for daemon in state['daemons']:
+                # Delete Docker containers starting with "host" or "router"
+                for container in list_containers(daemon):
+                    if container.startswith('host') or container.startswith('router'):
+                        subprocess.run(docker_cmd(daemon) + ['rm', '-f', container], check=False, capture_output=True)
 
-        # Delete Docker containers starting with "host" or "router"
-        containers = subprocess.check_output(['docker', 'ps', '-a', '--format', '{{.Names}}']).decode().splitlines()
-        for container in containers:
-            if container.startswith('host') or container.startswith('router'):
-                subprocess.run(['docker', 'rm', '-f', container], check=False, capture_output=True)
+                # Delete Docker networks starting with "net"
+                networks = subprocess.check_output(docker_cmd(daemon) + ['network', 'ls', '--format', '{{.Name}}']).decode().splitlines()
+                for network in networks:
+                    if network.startswith('net'):
+                        subprocess.run(docker_cmd(daemon) + ['network', 'rm', network], check=False, capture_output=True)
+            state['placement'] = {}
+            save_daemons(state)
 
         return jsonify({'message': 'Topology cleared successfully'})
     except subprocess.CalledProcessError as e:
@@ -140,9 +328,13 @@ def delete_node():
         container_name = f"{node_type.lower()}{node_id}"
         
         # Delete Docker container
-        containers = subprocess.check_output(['docker', 'ps', '-a', '--format', '{{.Names}}']).decode().splitlines()
-        if container_name in containers:
-            subprocess.run(['docker', 'rm', '-f', container_name], check=False, capture_output=True)
+        with daemons_lock:
+            state = load_daemons()
+            daemon = container_daemon(container_name, state)
+            if container_name in list_containers(daemon):
+                subprocess.run(docker_cmd(daemon) + ['rm', '-f', container_name], check=False, capture_output=True)
+            if state['placement'].pop(container_name, None):
+                save_daemons(state)
         
         # Update topology.json
         config = load_config()
@@ -158,6 +350,943 @@ def delete_node():
     except Exception as e:
         return jsonify({'error': f'Failed to delete node: {str(e)}'}), 500
 
+# Link impairment attributes an edge may carry:
+# delay and jitter in milliseconds, rate in kbit/s, loss in percent
+LINK_ATTRS = ('delay', 'jitter', 'rate', 'loss')
+
+# tc errors for deleting a root qdisc that is not there
+NO_QDISC_ERRORS = ('Cannot delete qdisc with handle of zero', 'No such file or directory')
+
+def edge_key(edge):
+    return frozenset((int(edge['source']), int(edge['target'])))
+
+def node_container(node):
+    return f"{node['type'].lower()}{node['id']}"
+
+def parse_link_profile(data):
+    profile = {}
+    for attr in LINK_ATTRS:
+        value = data.get(attr)
+        if value is None or value == '':
+            continue
+        value = float(value)
+        if not math.isfinite(value) or value < 0 or (attr == 'loss' and value > 100):
+            raise ValueError(f'Invalid {attr} value: {value:g}')
+        profile[attr] = value
+    if 'jitter' in profile and 'delay' not in profile:
+        raise ValueError('Jitter requires a delay')
+    if profile.get('rate') == 0:
+        raise ValueError('Rate must be greater than 0')
+    return profile
+
+def link_profile(edge):
+    return {attr: edge[attr] for attr in LINK_ATTRS if attr in edge}
+
+# Build the tc commands that put a profile on an interface:
+# netem at the root for delay/jitter/loss, tbf below it for the rate
+def tc_commands(interface, profile):
+    commands = [f'qdisc del dev {interface} root']
+    if not profile:
+        return commands
+
+    netem = f'qdisc add dev {interface} root handle 1: netem'
+    if 'delay' in profile:
+        netem += f" delay {profile['delay']:g}ms"
+        if 'jitter' in profile:
+            netem += f" {profile['jitter']:g}ms"
+    if 'loss' in profile:
+        netem += f" loss {profile['loss']:g}%"
+    commands.append(netem)
+
+    if 'rate' in profile:
+        burst = max(32, profile['rate'] / 100)
+        commands.append(f"qdisc add dev {interface} parent 1:1 handle 10: tbf "
+                        f"rate {profile['rate']:g}kbit burst {burst:g}kbit latency 400ms")
+    return commands
+
+# Map each container's lab networks ("net*") to the MAC address it uses on them
+def container_networks(containers):
+    state = load_daemons()
+    by_daemon = {}
+    for container in containers:
+        by_daemon.setdefault(container_daemon(container, state)['name'], []).append(container)
+
+    networks = {}
+    for daemon in state['daemons']:
+        if daemon['name'] not in by_daemon:
+            continue
+        result = subprocess.run(docker_cmd(daemon) + ['inspect'] + by_daemon[daemon['name']],
+                                capture_output=True, text=True, check=False)
+        for info in json.loads(result.stdout or '[]'):
+            name = info['Name'].lstrip('/')
+            networks[name] = {
+                network: settings.get('MacAddress')
+                for network, settings in (info.get('NetworkSettings', {}).get('Networks') or {}).items()
+                if network.startswith('net')
+            }
+    return networks
+
+# Map MAC addresses to interface names inside a container
+def container_interfaces(container):
+    output = subprocess.check_output(container_docker(container) + ['exec', container, 'ip', '-o', 'link']).decode()
+    interfaces = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if 'link/ether' in fields:
+            interfaces[fields[fields.index('link/ether') + 1]] = fields[1].rstrip(':').split('@')[0]
+    return interfaces
+
+# Find the interfaces a link's profile goes on: those of both containers on
+# the networks they share, or for a link to a switch, those of the container
+# on the switch segment (the networks it shares with the switch's other
+# containers). netem shapes egress, so a switch link only impairs traffic
+# leaving the container.
+def resolve_links(config, edges):
+    nodes = {node['id']: node for node in config['nodes']}
+    linked = {}
+    for edge in config['edges']:
+        linked.setdefault(int(edge['source']), []).append(int(edge['target']))
+        linked.setdefault(int(edge['target']), []).append(int(edge['source']))
+
+    links = []
+    errors = []
+    for edge in edges:
+        ends = [nodes.get(int(edge['source'])), nodes.get(int(edge['target']))]
+        if None in ends or all(node['type'] == 'Switch' for node in ends):
+            errors.append(f"Link {edge['source']}-{edge['target']} has no container end")
+            continue
+        switches = [node for node in ends if node['type'] == 'Switch']
+        if not switches:
+            pair = [node_container(node) for node in ends]
+            links.append((edge, pair, pair))
+            continue
+        container = next(node_container(node) for node in ends if node['type'] != 'Switch')
+        members = [node_container(nodes[n]) for n in linked.get(switches[0]['id'], [])
+                   if n in nodes and nodes[n]['type'] != 'Switch' and node_container(nodes[n]) != container]
+        if not members:
+            errors.append(f"Switch {switches[0]['id']} has no other container to find the segment of {container}")
+            continue
+        links.append((edge, [container], members + [container]))
+
+    networks = container_networks({name for _, _, peers in links for name in peers})
+    interfaces = {}
+    resolved = []
+    for edge, shaped, peers in links:
+        if len(shaped) == 2:
+            shared = set(networks.get(shaped[0], {})) & set(networks.get(shaped[1], {}))
+        else:
+            shared = set(networks.get(shaped[0], {})) & {network for peer in peers if peer != shaped[0]
+                                                          for network in networks.get(peer, {})}
+        if not shared:
+            errors.append(f"Containers {shaped[0]} and {shaped[1]} share no network" if len(shaped) == 2
+                          else f"{shaped[0]} shares no network with the other containers on its switch")
+            continue
+        ends = {}
+        for container in shaped:
+            if container not in interfaces:
+                interfaces[container] = container_interfaces(container)
+            ends[container] = [interfaces[container][networks[container][network]]
+                               for network in sorted(shared)
+                               if networks[container][network] in interfaces[container]]
+        resolved.append((edge, ends))
+    return resolved, errors
+
+# Apply the profiles of the given edges, one tc batch per container
+def apply_link_profiles(config, edges):
+    resolved, errors = resolve_links(config, edges)
+    return errors + apply_resolved_links(resolved)
+
+def apply_resolved_links(resolved):
+    errors = []
+    batches = {}
+    for edge, ends in resolved:
+        for container, container_ifaces in ends.items():
+            for interface in container_ifaces:
+                batches.setdefault(container, []).extend(tc_commands(interface, link_profile(edge)))
+
+    for container, commands in batches.items():
+        # -force keeps the batch going when there is no qdisc to delete
+        result = subprocess.run(container_docker(container) + ['exec', '-i', container, 'tc', '-force', '-batch', '-'],
+                                input='\n'.join(commands) + '\n', capture_output=True, text=True)
+        failures = [line for line in result.stderr.splitlines()
+                    if line.strip() and not line.startswith('Command failed')
+                    and not any(message in line for message in NO_QDISC_ERRORS)]
+        if failures:
+            errors.append(f"{container}: {' '.join(failures)}")
+    return errors
+
+def find_edge(config, data):
+    key = edge_key(data)
+    for edge in config['edges']:
+        if edge_key(edge) == key:
+            return edge
+    return None
+
+@app.route('/set_link_profile', methods=['POST'])
+def set_link_profile():
+    data = request.get_json()
+    if not data or 'source' not in data or 'target' not in data:
+        return jsonify({'error': 'Missing link source or target'}), 400
+
+    try:
+        profile = parse_link_profile(data)
+        config = load_config()
+        edge = find_edge(config, data)
+        if not edge:
+            return jsonify({'error': f"No link between {data['source']} and {data['target']}"}), 404
+
+        for attr in LINK_ATTRS:
+            edge.pop(attr, None)
+        edge.update(profile)
+
+        # Only store profiles for links we can actually put them on
+        resolved, errors = resolve_links(config, [edge])
+        if errors:
+            return jsonify({'error': '; '.join(errors)}), 400
+
+        error = save_config(config)
+        if error:
+            return jsonify({'error': f'Failed to update topology: {error}'}), 500
+
+        errors = apply_resolved_links(resolved)
+        if errors:
+            return jsonify({'error': '; '.join(errors), 'profile': profile}), 500
+        return jsonify({'message': 'Link profile applied successfully', 'profile': profile})
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid link profile: {str(e)}'}), 400
+    except subprocess.CalledProcessError as e:
+        return jsonify({'error': f'Failed to apply link profile: {str(e)}'}), 500
+
+@app.route('/link_profile', methods=['POST'])
+def get_link_profile():
+    data = request.get_json()
+    if not data or 'source' not in data or 'target' not in data:
+        return jsonify({'error': 'Missing link source or target'}), 400
+
+    config = load_config()
+    edge = find_edge(config, data)
+    if not edge:
+        return jsonify({'error': f"No link between {data['source']} and {data['target']}"}), 404
+
+    # Read back what is actually installed on the interfaces
+    applied = {}
+    try:
+        resolved, errors = resolve_links(config, [edge])
+        for _, ends in resolved:
+            for container, container_ifaces in ends.items():
+                for interface in container_ifaces:
+                    output = subprocess.check_output(container_docker(container) +
+                                                     ['exec', container, 'tc', 'qdisc', 'show', 'dev', interface])
+                    applied.setdefault(container, {})[interface] = output.decode().strip().splitlines()
+    except subprocess.CalledProcessError as e:
+        errors = [str(e)]
+
+    return jsonify({'profile': link_profile(edge), 'applied': applied, 'errors': errors})
+
+@app.route('/apply_link_profiles', methods=['POST'])
+def apply_all_link_profiles():
+    config = load_config()
+    edges = [edge for edge in config['edges'] if link_profile(edge)]
+    try:
+        errors = apply_link_profiles(config, edges)
+    except subprocess.CalledProcessError as e:
+        errors = [str(e)]
+    if errors:
+        return jsonify({'error': '; '.join(errors)}), 500
+    return jsonify({'message': f'Applied {len(edges)} link profiles'})
+
+# Lab snapshots: the topology plus every node's config in one gzipped JSON archive
+SNAPSHOT_DIR = 'snapshots'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_WORKERS = 32
+NODE_CONFIG_FILES = {
+    'router': 'router_config.json',
+    'host': 'host_config.json'
+}
+
+def snapshot_path(name):
+    if not re.fullmatch(r'[\w.-]+', name):
+        raise ValueError(f'Invalid snapshot name: {name}')
+    return os.path.join(SNAPSHOT_DIR, f'{name}.json.gz')
+
+def read_node_config(node):
+    config_file = NODE_CONFIG_FILES[node['type'].lower()]
+    result = subprocess.run(container_docker(node_container(node)) + ['exec', node_container(node), 'cat', f'/app/{config_file}'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout)
+
+# Subnet and IP address of every network a node config attaches to
+def node_networks(node_type, node_config):
+    networks = []
+    if node_type == 'router':
+        for addr in node_config.get('addresses', []):
+            ip_net = ip_network(addr['address'], strict=False)
+            networks.append((addr.get('subnet') or f"{ip_net.network_address}/{ip_net.prefixlen}",
+                             addr['address'].split('/')[0]))
+    elif node_config.get('interface', {}).get('ip_address'):
+        interface = node_config['interface']
+        mask_bits = sum(bin(int(part)).count('1') for part in interface['subnet_mask'].split('.'))
+        raw_ip = interface['ip_address'].split('/')[0]
+        net = ip_network(f"{raw_ip}/{mask_bits}", strict=False)
+        networks.append((f"{net.network_address}/{mask_bits}", raw_ip))
+    return networks
+
+# Routes a node config installs, as ip batch commands
+def node_route_commands(node_type, node_config):
+    if node_type == 'router':
+        return [f"route replace {route['destination']} via {route['next_hop']}"
+                for route in node_config.get('routes', [])]
+    gateway = node_config.get('interface', {}).get('default_gateway')
+    return [f'route replace default via {gateway}'] if gateway else []
+
+# Describe the Docker networks of a daemon: name, subnet and Linux bridge
+def inspect_networks(daemon):
+    names = subprocess.check_output(docker_cmd(daemon) + ['network', 'ls', '--format', '{{.Name}}']).decode().split()
+    result = subprocess.run(docker_cmd(daemon) + ['network', 'inspect'] + names, capture_output=True, text=True)
+    networks = []
+    for network in json.loads(result.stdout or '[]'):
+        options = network.get('Options') or {}
+        bridge = options.get('com.docker.network.bridge.name') or f"br-{network['Id'][:12]}"
+        mtu = int(options.get('com.docker.network.driver.mtu', 1500))
+        for ipam in (network.get('IPAM') or {}).get('Config') or []:
+            if ipam.get('Subnet'):
+                networks.append({'name': network['Name'], 'subnet': ipam['Subnet'], 'bridge': bridge, 'mtu': mtu})
+    return networks
+
+# Map subnets to the existing Docker networks that carry them
+def network_subnets(daemon):
+    return {network['subnet']: network['name'] for network in inspect_networks(daemon)}
+
+def create_network(subnet, daemon):
+    ip_net = ip_network(subnet)
+    network_name = f'net_{str(ip_net.network_address).replace(".", "_")}_{ip_net.prefixlen}'
+    subprocess.run(docker_cmd(daemon) + ['network', 'create', '--subnet', subnet,
+                                         '-o', f'com.docker.network.driver.mtu={LAB_MTU}', network_name],
+                   capture_output=True, text=True, check=True)
+    return network_name
+
+def config_archive(node_type, node_config):
+    data = json.dumps(node_config, indent=4).encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        info = tarfile.TarInfo(NODE_CONFIG_FILES[node_type])
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+# Recreate one node: an existing container is replaced, so no networks or routes
+# from outside the snapshot survive, and the new one gets its config before it
+# boots so the node app starts up with it
+def restore_node(node, node_config, daemon, networks, existing):
+    node_type = node['type'].lower()
+    container_name = node_container(node)
+    docker = docker_cmd(daemon)
+    if container_name in existing:
+        subprocess.run(docker + ['rm', '-f', container_name], capture_output=True, text=True, check=True)
+    subprocess.run(docker + ['create', '-it'] + container_args(node_type, node['id'], daemon),
+                   capture_output=True, text=True, check=True)
+
+    if node_config is not None:
+        subprocess.run(docker + ['cp', '-', f'{container_name}:/app'],
+                       input=config_archive(node_type, node_config), capture_output=True, check=True)
+        for subnet, raw_ip in node_networks(node_type, node_config):
+            result = subprocess.run(docker + ['network', 'connect', '--ip', raw_ip, networks[subnet], container_name],
+                                    capture_output=True, text=True)
+            if result.returncode != 0 and 'already exists' not in result.stderr:
+                raise subprocess.CalledProcessError(result.returncode, result.args, stderr=result.stderr)
+
+    subprocess.run(docker + ['start', container_name], capture_output=True, text=True, check=True)
+    track_launch(container_name)
+
+    commands = node_route_commands(node_type, node_config) if node_config else []
+    if commands:
+        subprocess.run(docker + ['exec', '-i', container_name, 'ip', '-force', '-batch', '-'],
+                       input='\n'.join(commands) + '\n', capture_output=True, text=True, check=True)
+
+def pool_errors(futures):
+    errors = []
+    for key, future in futures.items():
+        try:
+            future.result()
+        except subprocess.CalledProcessError as e:
+            errors.append(f'{key}: {e.stderr or str(e)}'.strip())
+        except Exception as e:
+            errors.append(f'{key}: {str(e)}')
+    return errors
+
+@app.route('/snapshot', methods=['POST'])
+def take_snapshot():
+    data = request.get_json(silent=True) or {}
+    name = data.get('name') or datetime.now().strftime('%Y%m%d-%H%M%S')
+    try:
+        path = snapshot_path(name)
+        config = load_config()
+        nodes = [node for node in config['nodes'] if node['type'].lower() in NODE_CONFIG_FILES]
+        with ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS) as pool:
+            configs = dict(zip([node_container(node) for node in nodes], pool.map(read_node_config, nodes)))
+
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'topology': config,
+            'configs': configs
+        }
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with gzip.open(path, 'wt') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+
+        missing = [name for name, node_config in configs.items() if node_config is None]
+        return jsonify({'message': f'Snapshot {name} saved', 'snapshot': name, 'missing': missing})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Failed to take snapshot: {str(e)}'}), 500
+
+@app.route('/snapshots')
+def list_snapshots():
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return jsonify({'snapshots': []})
+    snapshots = []
+    for filename in sorted(os.listdir(SNAPSHOT_DIR)):
+        if filename.endswith('.json.gz'):
+            path = os.path.join(SNAPSHOT_DIR, filename)
+            snapshots.append({'name': filename[:-len('.json.gz')], 'size': os.path.getsize(path)})
+    return jsonify({'snapshots': snapshots})
+
+@app.route('/restore_snapshot', methods=['POST'])
+def restore_snapshot():
+    data = request.get_json(silent=True) or {}
+    if not data.get('name'):
+        return jsonify({'error': 'Missing snapshot name'}), 400
+
+    start = time.time()
+    try:
+        with gzip.open(snapshot_path(data['name']), 'rt') as f:
+            snapshot = json.load(f)
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            return jsonify({'error': f"Unsupported snapshot version: {snapshot.get('version')}"}), 400
+
+        topology = snapshot['topology']
+        error = save_config({'nodes': topology['nodes'], 'edges': topology['edges']})
+        if error:
+            return jsonify({'error': f'Failed to restore topology: {error}'}), 500
+
+        nodes = [node for node in topology['nodes'] if node['type'].lower() in NODE_CONFIG_FILES]
+        configs = snapshot['configs']
+        with daemons_lock:
+            state = load_daemons()
+            place_nodes(topology, state)
+            save_daemons(state)
+        daemons = {node_container(node): container_daemon(node_container(node), state) for node in nodes}
+        used = {daemon['name']: daemon for daemon in daemons.values()}
+
+        with ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS) as pool:
+            futures = {f"{daemon_name}/{image_name}": pool.submit(ensure_image, image_name, used[daemon_name])
+                       for daemon_name, image_name in {(daemons[node_container(node)]['name'], node['type'].lower())
+                                                       for node in nodes}}
+            errors = pool_errors(futures)
+
+            # Networks first, each subnet once per daemon
+            networks = {daemon_name: network_subnets(daemon) for daemon_name, daemon in used.items()}
+            wanted = {(daemons[node_container(node)]['name'], subnet)
+                      for node in nodes if configs.get(node_container(node))
+                      for subnet, _ in node_networks(node['type'].lower(), configs[node_container(node)])}
+            futures = {f'{daemon_name}/{subnet}': pool.submit(create_network, subnet, used[daemon_name])
+                       for daemon_name, subnet in sorted(wanted) if subnet not in networks[daemon_name]}
+            errors += pool_errors(futures)
+            for key, future in futures.items():
+                if not future.exception():
+                    daemon_name, subnet = key.split('/', 1)
+                    networks[daemon_name][subnet] = future.result()
+
+            existing = {daemon_name: set(list_containers(daemon)) for daemon_name, daemon in used.items()}
+            replaced = sorted(node_container(node) for node in nodes
+                              if node_container(node) in existing[daemons[node_container(node)]['name']])
+            futures = {}
+            for node in nodes:
+                container = node_container(node)
+                daemon = daemons[container]
+                futures[container] = pool.submit(restore_node, node, configs.get(container), daemon,
+                                                 networks[daemon['name']], existing[daemon['name']])
+            errors += pool_errors(futures)
+
+        # The containers are new, so their links need their profiles again
+        profiled = [edge for edge in topology['edges'] if link_profile(edge)]
+        if profiled:
+            errors += apply_link_profiles(topology, profiled)
+
+        elapsed = round(time.time() - start, 2)
+        if errors:
+            return jsonify({'error': '; '.join(errors), 'replaced': replaced, 'seconds': elapsed}), 500
+        return jsonify({'message': f"Snapshot {data['name']} restored in {elapsed}s",
+                        'topology': topology, 'replaced': replaced, 'seconds': elapsed})
+    except FileNotFoundError:
+        return jsonify({'error': f"Snapshot {data['name']} not found"}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except subprocess.CalledProcessError as e:
+        return jsonify({'error': f'Docker error: {e.stderr or str(e)}'}), 500
+    except Exception as e:
+        return jsonify({'error': f'Failed to restore snapshot: {str(e)}'}), 500
+
+@app.route('/daemons')
+def list_daemons():
+    state = load_daemons()
+    loads = daemon_loads(state)
+    total_weight = sum(daemon['weight'] for daemon in state['daemons'])
+    daemons = [dict(daemon, nodes=loads[daemon['name']], share=round(daemon['weight'] / total_weight, 3))
+               for daemon in state['daemons']]
+    return jsonify({'daemons': daemons, 'placement': state['placement']})
+
+@app.route('/add_daemon', methods=['POST'])
+def add_daemon():
+    data = request.get_json(silent=True) or {}
+    name = data.get('name', '')
+    endpoint = data.get('endpoint', '')
+    if not re.fullmatch(r'[\w.-]+', name):
+        return jsonify({'error': f'Invalid daemon name: {name}'}), 400
+    if not endpoint.startswith(('unix://', 'tcp://')):
+        return jsonify({'error': 'Endpoint must be a unix:// socket or a tcp:// address'}), 400
+    try:
+        weight = float(data.get('weight', 1))
+        if not math.isfinite(weight) or weight <= 0:
+            raise ValueError('Weight must be a finite number greater than 0')
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid weight: {str(e)}'}), 400
+
+    daemon = {
+        'name': name,
+        'endpoint': endpoint,
+        'weight': weight,
+        # Address nodes are reached on and the VXLAN underlay address
+        'address': data.get('address') or urlparse(endpoint).hostname or 'localhost',
+        'mount_sources': bool(data.get('mount_sources', False))
+    }
+    try:
+        subprocess.run(docker_cmd(daemon) + ['version', '--format', '{{.Server.Version}}'],
+                       capture_output=True, text=True, check=True, timeout=10)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        return jsonify({'error': f'Docker daemon {endpoint} is not reachable: {getattr(e, "stderr", None) or str(e)}'}), 400
+
+    # Adding a daemon under an existing name updates it, e.g. to give the
+    # local daemon a routable address for VXLAN
+    with daemons_lock:
+        state = load_daemons()
+        for index, existing in enumerate(state['daemons']):
+            if existing['name'] == name:
+                state['daemons'][index] = daemon
+                break
+        else:
+            state['daemons'].append(daemon)
+        save_daemons(state)
+    result = {'message': f'Daemon {name} saved', 'daemon': daemon}
+    if not agent_url(daemon):
+        result['warning'] = 'TOPOLOGY_ADDRESS is not set, nodes on this daemon will run without an agent'
+    return jsonify(result)
+
+@app.route('/remove_daemon', methods=['POST'])
+def remove_daemon():
+    data = request.get_json(silent=True) or {}
+    with daemons_lock:
+        state = load_daemons()
+        if not any(daemon['name'] == data.get('name') for daemon in state['daemons']):
+            return jsonify({'error': f"No daemon named {data.get('name')}"}), 404
+        if daemon_loads(state)[data['name']]:
+            return jsonify({'error': f"Daemon {data['name']} still has nodes placed on it"}), 400
+        if len(state['daemons']) == 1:
+            return jsonify({'error': 'Cannot remove the last daemon'}), 400
+        state['daemons'] = [daemon for daemon in state['daemons'] if daemon['name'] != data['name']]
+        save_daemons(state)
+    return jsonify({'message': f"Daemon {data['name']} removed"})
+
+def vxlan_id(subnet):
+    return zlib.crc32(subnet.encode()) % 0xFFFFFE + 1
+
+# Attach a VXLAN device to the bridge of a network on one daemon, with a
+# flood entry for every peer daemon carrying the same subnet. It runs in a
+# throwaway host-network container since the daemon host is not reachable otherwise.
+def stitch_network(daemon, subnet, bridge, peers):
+    device = f'vx{vxlan_id(subnet)}'
+    script = [
+        f'ip link show {device} >/dev/null 2>&1 || '
+        f'ip link add {device} type vxlan id {vxlan_id(subnet)} dstport {VXLAN_PORT}',
+        f'ip link set {device} mtu {LAB_MTU}',
+        f'ip link set {device} master {bridge}',
+        f'ip link set {device} up'
+    ]
+    script += [f'bridge fdb append 00:00:00:00:00:00 dev {device} dst {peer} 2>/dev/null || true' for peer in peers]
+    ensure_image('router', daemon)
+    subprocess.run(docker_cmd(daemon) + ['run', '--rm', '--net', 'host', '--cap-add', 'NET_ADMIN',
+                                         '--entrypoint', 'sh', 'router', '-c', 'set -e; ' + '; '.join(script)],
+                   capture_output=True, text=True, check=True)
+
+# Bridge the subnets shared by links whose ends sit on different daemons
+@app.route('/connect_cross_links', methods=['POST'])
+def connect_cross_links():
+    config = load_config()
+    state = load_daemons()
+    daemons = {daemon['name']: daemon for daemon in state['daemons']}
+    nodes = {node['id']: node for node in config['nodes']}
+
+    cross = []
+    for edge in config['edges']:
+        ends = [nodes.get(edge['source']), nodes.get(edge['target'])]
+        if None in ends or any(node['type'] == 'Switch' for node in ends):
+            continue
+        containers = [node_container(node) for node in ends]
+        if container_daemon(containers[0], state)['name'] != container_daemon(containers[1], state)['name']:
+            cross.append(containers)
+    if not cross:
+        return jsonify({'message': 'No links cross daemons', 'stitched': {}})
+
+    try:
+        networks = container_networks({container for pair in cross for container in pair})
+        by_name = {name: {network['name']: network for network in inspect_networks(daemon)}
+                   for name, daemon in daemons.items()
+                   if any(container_daemon(c, state)['name'] == name for pair in cross for c in pair)}
+
+        # subnet -> {daemon name: bridge}
+        segments = {}
+        oversized = set()
+        for pair in cross:
+            subnets = []
+            for container in pair:
+                daemon_networks = by_name[container_daemon(container, state)['name']]
+                subnets.append({daemon_networks[n]['subnet']: daemon_networks[n]['bridge']
+                                for n in networks.get(container, {}) if n in daemon_networks})
+                oversized |= {daemon_networks[n]['subnet'] for n in networks.get(container, {})
+                              if n in daemon_networks and daemon_networks[n]['mtu'] > LAB_MTU}
+            for subnet in set(subnets[0]) & set(subnets[1]):
+                for container, bridges in zip(pair, subnets):
+                    segments.setdefault(subnet, {})[container_daemon(container, state)['name']] = bridges[subnet]
+
+        with ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS) as pool:
+            futures = {}
+            for subnet, bridges in segments.items():
+                for daemon_name, bridge in bridges.items():
+                    peers = [daemons[other]['address'] for other in bridges if other != daemon_name]
+                    futures[f'{daemon_name}/{subnet}'] = pool.submit(stitch_network, daemons[daemon_name],
+                                                                     subnet, bridge, peers)
+            errors = pool_errors(futures)
+    except subprocess.CalledProcessError as e:
+        errors = [e.stderr or str(e)]
+
+    if errors:
+        return jsonify({'error': '; '.join(errors)}), 500
+    stitched = {subnet: sorted(bridges) for subnet, bridges in segments.items()}
+    # Networks created before LAB_MTU existed still hand out 1500 byte links,
+    # full size frames on them are dropped where they enter the VXLAN port
+    warnings = [f'Network for {subnet} has an MTU above {LAB_MTU}, recreate it to pass full size frames'
+                for subnet in sorted(oversized & set(segments))]
+    return jsonify({'message': f'Stitched {len(stitched)} subnets across daemons', 'stitched': stitched,
+                    'warnings': warnings})
+
+# Node agents
+# Every router and host keeps a long-poll request open to /agent/poll over
+# one keep-alive connection. Config batches are handed out as the answer to
+# that poll and the node sends back its acks and health on the next one.
+# Each agent has its own condition and each push its own, all on one lock,
+# so a poll or an ack only wakes the threads waiting on that node.
+AGENT_POLL_TIMEOUT = 25
+AGENT_ACK_TIMEOUT = 30
+
+agents_lock = threading.Lock()
+agents = {}
+agent_batches = [0]
+
+# Called with agents_lock held. 'waiting' maps unacknowledged batch ids to the
+# condition of the push waiting on them, 'poll' is the generation of the newest poll
+def agent_state(node):
+    if node not in agents:
+        agents[node] = {'pending': [], 'waiting': {}, 'results': {}, 'health': None, 'last_seen': None,
+                        'poll': 0, 'changed': threading.Condition(agents_lock)}
+    return agents[node]
+
+def agent_connected(agent):
+    return agent['last_seen'] is not None and time.time() - agent['last_seen'] < AGENT_POLL_TIMEOUT + 10
+
+@app.route('/agent/poll', methods=['POST'])
+def agent_poll():
+    data = request.get_json(silent=True) or {}
+    if not data.get('node'):
+        return jsonify({'error': 'Missing node name'}), 400
+
+    with agents_lock:
+        agent = agent_state(data['node'])
+        agent['last_seen'] = time.time()
+        agent['health'] = data.get('health')
+        for ack in data.get('acks', []):
+            # Acks for pushes that already gave up waiting are dropped
+            pushed = agent['waiting'].pop(ack['batch'], None)
+            if pushed is not None:
+                agent['results'][ack['batch']] = ack['results']
+                pushed.notify()
+
+        # A newer poll from the same node (it reconnected) supersedes this one,
+        # so batches are never handed to a request nobody reads any more
+        agent['poll'] += 1
+        generation = agent['poll']
+        agent['changed'].notify_all()
+        agent['changed'].wait_for(lambda: agent['pending'] or agent['poll'] != generation,
+                                  timeout=AGENT_POLL_TIMEOUT)
+        if agent['poll'] != generation:
+            return jsonify({'batches': []})
+        batches, agent['pending'] = agent['pending'], []
+        agent['last_seen'] = time.time()
+    return jsonify({'batches': batches})
+
+# Queue one batch of operations per node, then wait for the acks.
+# Operations name a node UI form, e.g. {"op": "add_route", "destination": ..., "next_hop": ...}
+@app.route('/push_config', methods=['POST'])
+def push_config():
+    data = request.get_json(silent=True) or {}
+    batches = data.get('nodes')
+    if not isinstance(batches, dict) or not batches:
+        return jsonify({'error': 'Missing operations per node'}), 400
+    if not all(isinstance(ops, list) for ops in batches.values()):
+        return jsonify({'error': 'Operations must be a list per node'}), 400
+    try:
+        timeout = float(data.get('timeout', AGENT_ACK_TIMEOUT))
+        if not math.isfinite(timeout) or timeout <= 0:
+            raise ValueError(timeout)
+        timeout = min(timeout, AGENT_ACK_TIMEOUT)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Timeout must be a positive number of seconds'}), 400
+
+    start = time.time()
+    sent = {}
+    results = {}
+    with agents_lock:
+        acked = threading.Condition(agents_lock)
+        for node, ops in batches.items():
+            # Only nodes whose agent has connected at least once can be pushed to
+            agent = agents.get(node)
+            if agent is None:
+                results[node] = {'status': 'unknown'}
+                continue
+            agent_batches[0] += 1
+            agent['pending'].append({'id': agent_batches[0], 'ops': ops})
+            agent['waiting'][agent_batches[0]] = acked
+            sent[node] = agent_batches[0]
+            agent['changed'].notify_all()
+        acked.wait_for(lambda: all(batch not in agents[node]['waiting'] for node, batch in sent.items()),
+                       timeout=timeout)
+
+        for node, batch in sent.items():
+            agent = agents[node]
+            if batch in agent['results']:
+                results[node] = {'status': 'done', 'results': agent['results'].pop(batch)}
+                continue
+            agent['waiting'].pop(batch, None)
+            undelivered = [queued for queued in agent['pending'] if queued['id'] == batch]
+            if undelivered:
+                # Never handed out: withdraw it so the node does not apply it later
+                agent['pending'].remove(undelivered[0])
+                results[node] = {'status': 'offline' if not agent_connected(agent) else 'undelivered'}
+            else:
+                # Handed out but not acknowledged in time, the node may still apply it
+                results[node] = {'status': 'pending'}
+
+    failed = [node for node, result in results.items()
+              if result['status'] != 'done' or not all(op['ok'] for op in result['results'])]
+    return jsonify({'results': results, 'failed': failed, 'seconds': round(time.time() - start, 3)}), 207 if failed else 200
+
+@app.route('/agents')
+def list_agents():
+    with agents_lock:
+        return jsonify({'agents': {node: {
+            'connected': agent_connected(agent),
+            'last_seen': agent['last_seen'],
+            'pending': len(agent['pending']),
+            'unacknowledged': len(agent['waiting']),
+            'health': agent['health']
+        } for node, agent in agents.items()}})
+
+# Node health
+# A prober thread checks all nodes every PROBE_INTERVAL: container state with
+# one docker ps per daemon, readiness with GET /healthz on every running node
+# in parallel over keep-alive connections kept from round to round.
+PROBE_INTERVAL = 2
+PROBE_TIMEOUT = 2
+PROBE_WORKERS = 64
+
+status_changed = threading.Condition()
+node_status = {}
+status_events = deque(maxlen=1000)
+status_counter = [0]
+prober = {'thread': None, 'round_seconds': None, 'last_round': None}
+probe_connections = {}
+
+def track_launch(container):
+    with status_changed:
+        entry = node_status.setdefault(container, {})
+        entry.update({'launched': time.time(), 'ready_since': None, 'startup_seconds': None})
+        set_status(container, 'starting')
+
+# Record a status and queue an event for the streams; called with status_changed held
+def set_status(container, status, error=None):
+    entry = node_status.setdefault(container, {'launched': None, 'ready_since': None, 'startup_seconds': None})
+    entry['error'] = error
+    if entry.get('status') == status:
+        return
+    entry['status'] = status
+    entry['changed'] = time.time()
+    if status == 'ready':
+        entry['ready_since'] = entry['changed']
+        if entry['launched'] and entry['startup_seconds'] is None:
+            entry['startup_seconds'] = round(entry['changed'] - entry['launched'], 3)
+    status_counter[0] += 1
+    status_events.append((status_counter[0], {'node': container, 'status': status,
+                                              'startup_seconds': entry['startup_seconds']}))
+    status_changed.notify_all()
+
+def container_states(daemon):
+    output = subprocess.check_output(docker_cmd(daemon) + ['ps', '-a', '--format', '{{.Names}}\t{{.State}}'],
+                                     timeout=PROBE_TIMEOUT * 5).decode()
+    return dict(line.split('\t', 1) for line in output.splitlines() if '\t' in line)
+
+def probe_http(container, address, port):
+    conn = probe_connections.get(container)
+    if conn is None or (conn.host, conn.port) != (address, port):
+        conn = probe_connections[container] = http.client.HTTPConnection(address, port, timeout=PROBE_TIMEOUT)
+    try:
+        conn.request('GET', '/healthz')
+        response = conn.getresponse()
+        response.read()
+        return response.status == 200, None if response.status == 200 else f'HTTP {response.status}'
+    except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        probe_connections.pop(container, None)
+        return False, str(e)
+
+def probe_round(pool):
+    started = time.time()
+    state = load_daemons()
+    containers = {node_container(node): node for node in load_config()['nodes'] if node['type'] != 'Switch'}
+    in_topology = set(containers)
+    # Nodes launched but not saved on the canvas yet are probed too
+    with status_changed:
+        for container in node_status:
+            if container not in containers:
+                image_name = re.sub(r'\d+$', '', container)
+                containers[container] = {'type': image_name.capitalize(), 'id': container[len(image_name):]}
+
+    daemons = {daemon['name']: daemon for daemon in state['daemons']}
+    used = {container_daemon(container, state)['name'] for container in containers}
+    futures = {name: pool.submit(container_states, daemons[name]) for name in used}
+    states = {}
+    for name, future in futures.items():
+        try:
+            states[name] = future.result()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            states[name] = None
+
+    probes = {}
+    results = {}
+    for container, node in containers.items():
+        daemon = container_daemon(container, state)
+        daemon_states = states.get(daemon['name'])
+        if daemon_states is None:
+            results[container] = ('unknown', f"Daemon {daemon['name']} unreachable")
+        elif container not in daemon_states:
+            results[container] = ('absent', None)
+        elif daemon_states[container] != 'running':
+            results[container] = ('stopped', daemon_states[container])
+        else:
+            port = node_ports(node['type'].lower(), node['id'])[1]
+            probes[container] = pool.submit(probe_http, container, daemon['address'], port)
+
+    for container, future in probes.items():
+        ready, error = future.result()
+        if ready:
+            results[container] = ('ready', None)
+        else:
+            # Never been ready since launch means still starting up
+            entry = node_status.get(container, {})
+            results[container] = ('unhealthy' if entry.get('ready_since') else 'starting', error)
+
+    with status_changed:
+        # Nodes launched after this round sampled docker keep their fresh 'starting'
+        relaunched = {c for c, entry in node_status.items() if (entry.get('launched') or 0) > started}
+        for container, (status, error) in results.items():
+            if container in relaunched:
+                continue
+            set_status(container, status, error)
+            node_status[container]['daemon'] = container_daemon(container, state)['name']
+        # Forget deleted nodes once their container is gone
+        for container in [c for c, entry in node_status.items()
+                          if c not in in_topology and c not in relaunched and entry['status'] == 'absent']:
+            del node_status[container]
+
+def probe_loop():
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+        while True:
+            start = time.time()
+            try:
+                probe_round(pool)
+            except Exception as e:
+                app.logger.warning(f'Health probe round failed: {e}')
+            prober['round_seconds'] = round(time.time() - start, 3)
+            prober['last_round'] = time.time()
+            time.sleep(max(0, PROBE_INTERVAL - (time.time() - start)))
+
+# Start probing from the serving process (not the debug reloader's parent)
+@app.before_request
+def ensure_prober():
+    if prober['thread'] is None:
+        with status_changed:
+            if prober['thread'] is None:
+                prober['thread'] = threading.Thread(target=probe_loop, daemon=True)
+                prober['thread'].start()
+
+@app.route('/status')
+def status_summary():
+    with status_changed:
+        counts = {}
+        for entry in node_status.values():
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        startups = [entry['startup_seconds'] for entry in node_status.values() if entry['startup_seconds'] is not None]
+        with agents_lock:
+            nodes = {container: dict(entry, agent=container in agents and agent_connected(agents[container]))
+                     for container, entry in node_status.items()}
+        return jsonify({
+            'counts': counts,
+            'nodes': nodes,
+            'startup_seconds': {
+                'max': max(startups, default=None),
+                'mean': round(sum(startups) / len(startups), 3) if startups else None
+            },
+            'probe_interval': PROBE_INTERVAL,
+            'round_seconds': prober['round_seconds'],
+            'last_round': prober['last_round']
+        })
+
+@app.route('/status/stream')
+def status_stream():
+    def events():
+        with status_changed:
+            last = status_counter[0]
+            snapshot = [{'node': container, 'status': entry['status'], 'startup_seconds': entry['startup_seconds']}
+                        for container, entry in node_status.items()]
+        for event in snapshot:
+            yield f'data: {json.dumps(event)}\n\n'
+        while True:
+            with status_changed:
+                status_changed.wait_for(lambda: status_counter[0] > last, timeout=15)
+                # Events that already fell out of the backlog are lost to slow streams
+                pending = [event for seq, event in status_events if seq > last]
+                last = status_counter[0]
+            if not pending:
+                yield ': keepalive\n\n'
+            for event in pending:
+                yield f'data: {json.dumps(event)}\n\n'
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
 if __name__ == '__main__':
     init_config_file()
     app.run(debug=True,host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -12,6 +12,17 @@ let edges = [];
 let connectMode = false;
 let selectedNode = null;
 let maxNodeId = 0; // Track highest node ID
+let nodeStatus = {}; // Container name -> status reported by the health prober
+let pendingWindows = {}; // Container name -> window waiting for the node to be ready
+const NODE_START_TIMEOUT = 60000; // ms to wait for a launched node to become ready
+
+const statusColors = {
+    ready: 'green',
+    starting: 'orange',
+    unhealthy: 'red',
+    stopped: 'red',
+    unknown: 'gray'
+};
 
 const deviceImages = {
     Host: '/static/images/host.png',
@@ -45,7 +56,8 @@ function addDevice(type, x = 50, y = 50, nodeId = null) {
             const label = new Konva.Text({
                 text: `${type}-${id}`,
                 fontSize: 12,
-                fill: 'black',
+                fill: statusColors[nodeStatus[`${type.toLowerCase()}${id}`]] || 'black',
+                name: 'label',
                 y: 20,
                 align: 'center'
             });
@@ -93,6 +105,9 @@ function addDevice(type, x = 50, y = 50, nodeId = null) {
         });
         group.on('dblclick', () => {
             if (type !== "Switch") {
+                const container = `${type.toLowerCase()}${id}`;
+                // Open the window now, while we still have the click, and point it at the node once it is ready
+                const win = window.open('', '_blank');
                 fetch('/launch_node', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
@@ -100,13 +115,25 @@ function addDevice(type, x = 50, y = 50, nodeId = null) {
                 })
                     .then(response => response.json())
                     .then(data => {
-                        if (data.url) {
-                            window.open(data.url, '_blank');
-                        } else {
+                        if (!data.url) {
+                            win.close();
                             showMessage(data.error || 'Unknown error', 'error');
+                        } else if (nodeStatus[container] === 'ready') {
+                            win.location = data.url;
+                        } else {
+                            closePendingWindow(container);
+                            const timer = setTimeout(() => {
+                                closePendingWindow(container);
+                                showMessage(`${type}-${id} did not become ready in time`, 'error');
+                            }, NODE_START_TIMEOUT);
+                            pendingWindows[container] = { win, url: data.url, timer };
+                            showMessage(`Waiting for ${type}-${id} to start...`, 'success');
                         }
                     })
-                    .catch(() => showMessage('Failed to open node UI', 'error'));
+                    .catch(() => {
+                        win.close();
+                        showMessage('Failed to open node UI', 'error');
+                    });
             }
         });
         // Handle right-click to delete
@@ -178,10 +205,13 @@ function redrawEdges() {
         const sourceGroup = layer.findOne(`#node-${edge.source}`);
         const targetGroup = layer.findOne(`#node-${edge.target}`);
         if (sourceGroup && targetGroup) {
+            // Impaired links (delay, jitter, rate or loss set) are drawn dashed
+            const impaired = ['delay', 'jitter', 'rate', 'loss'].some(attr => edge[attr] !== undefined);
             const line = new Konva.Line({
                 points: [sourceGroup.x(), sourceGroup.y(), targetGroup.x(), targetGroup.y()],
-                stroke: 'black',
+                stroke: impaired ? 'orange' : 'black',
                 strokeWidth: 2,
+                dash: impaired ? [8, 4] : [],
                 name: 'edge'
             });
             layer.add(line);
@@ -216,6 +246,42 @@ function showMessage(text, type = 'success') {
 
 
 
+// Live node status from the topology app's health prober
+const statusSource = new EventSource('/status/stream');
+statusSource.onmessage = (event) => {
+    const update = JSON.parse(event.data);
+    nodeStatus[update.node] = update.status;
+
+    const node = nodes.find(n => `${n.type.toLowerCase()}${n.id}` === update.node);
+    const group = node && layer.findOne(`#node-${node.id}`);
+    const label = group && group.findOne('.label');
+    if (label) {
+        label.fill(statusColors[update.status] || 'black');
+        layer.draw();
+    }
+
+    const pending = pendingWindows[update.node];
+    if (pending && update.status === 'ready') {
+        clearTimeout(pending.timer);
+        pending.win.location = pending.url;
+        delete pendingWindows[update.node];
+    } else if (pending && (update.status === 'stopped' || update.status === 'unhealthy')) {
+        // 'absent' and 'unknown' can come from a probe that raced the launch; the timeout covers those
+        closePendingWindow(update.node);
+        showMessage(`${update.node} failed to start (${update.status})`, 'error');
+    }
+};
+
+// Close the blank tab opened for a node that will not be shown after all
+function closePendingWindow(container) {
+    const pending = pendingWindows[container];
+    if (pending) {
+        clearTimeout(pending.timer);
+        pending.win.close();
+        delete pendingWindows[container];
+    }
+}
+
 // Event Listeners
 document.getElementById('addHost').addEventListener('click', () => addDevice('Host'));
 document.getElementById('addRouter').addEventListener('click', () => addDevice('Router'));